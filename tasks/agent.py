@@ -475,7 +475,8 @@ def clean(ctx):
 
     # remove the bin/agent folder
     print("Remove agent binary folder")
-    ctx.run("rm -rf ./bin/agent")
+    if os.path.exists(os.path.join("bin", "agent")):
+        shutil.rmtree(os.path.join("bin", "agent"))
 
     print("Cleaning rtloader")
     rtloader_clean(ctx)
@@ -91,7 +91,8 @@ def clean_common(ctx, rmdir):
 
     # remove the bin/agent folder
     print("Remove agent binary folder")
-    ctx.run("rm -rf ./bin/{rmdir}".format(rmdir=rmdir))
+    if os.path.exists(os.path.join("bin", rmdir)):
+        shutil.rmtree(os.path.join("bin", rmdir))
 
 
 def version_common(ctx, url_safe, git_sha_length):
@@ -279,7 +279,9 @@ def image_build(ctx, arch='amd64', skip_build=False):
     dockerfile_path = "{}/Dockerfile".format(arch)
 
     client.images.build(path=build_context, dockerfile=dockerfile_path, rm=True, tag=DOGSTATSD_TAG)
-    ctx.run("rm -rf {}/static".format(build_context))
+    static_dir = "{}/static".format(build_context)
+    if os.path.exists(static_dir):
+        shutil.rmtree(static_dir)
 
 
 @task
@@ -293,4 +295,5 @@ def clean(ctx):
 
     # remove the bin/dogstatsd folder
     print("Remove agent binary folder")
-    ctx.run("rm -rf ./bin/dogstatsd")
+    if os.path.exists(os.path.join("bin", "dogstatsd")):
+        shutil.rmtree(os.path.join("bin", "dogstatsd"))
@@ -4,11 +4,17 @@ Golang related tasks go here
 from __future__ import print_function
 import datetime
 import os
+import re
 import shutil
 import sys
 import csv
+import tempfile
+from io import StringIO
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE, check_call, check_output, CalledProcessError
+from threading import Event
 
-from invoke import task
+from invoke import task, Context
 from invoke.exceptions import Exit
 from .build_tags import get_default_build_tags
 from .utils import get_build_flags, get_gopath
@@ -22,7 +28,7 @@ except NameError:
     basestring = str
 
 # List of modules to ignore when running lint
-MODULE_WHITELIST = [
+MODULE_WHITELIST = frozenset([
     # Windows
     "doflare.go",
     "iostats_pdh_windows.go",
@@ -41,7 +47,7 @@ MODULE_WHITELIST = [
     # All
     "agent.pb.go",
     "bbscache_test.go",
-]
+])
 
 # List of paths to ignore in misspell's output
 MISSPELL_IGNORED_TARGETS = [
@@ -50,26 +56,115 @@ MISSPELL_IGNORED_TARGETS = [
     os.path.join("pkg", "collector", "corechecks", "system", "testfiles"),
     os.path.join("pkg", "ebpf", "testdata"),
 ]
+# Ignored paths are matched with a single precompiled regex: there are only a
+# few short literal paths, which doesn't justify a C-extension dependency that
+# would also have to build on the Windows builders
+MISSPELL_IGNORED_RE = re.compile("|".join(re.escape(target) for target in MISSPELL_IGNORED_TARGETS))
+
+# Maximum number of tools installed concurrently by `deps`
+DEPS_INSTALL_WORKERS = 8
 
-# Packages that need go:generate
+# Matches the licenses reported by `wwhrd list`, logrus sorts the fields so
+# the license always comes before the package
+WWHRD_LICENSE_RE = re.compile(r'msg="Found License".*? license=(\S*).*? package=(\S*)')
+
+# Packages that need go:generate, their directives must not depend on each other
 GO_GENERATE_TARGETS = [
     "./pkg/status",
     "./cmd/agent/gui"
 ]
 
+# The build env only depends on rtloader_root for the duration of an `invoke`
+# run, cache it so that chained tasks (e.g. `inv vet golangci_lint`) don't
+# spawn the processes get_build_flags needs again.
+_BUILD_ENV_CACHE = {}
+
+def _get_build_env(ctx, rtloader_root=None):
+    if rtloader_root not in _BUILD_ENV_CACHE:
+        _, _, env = get_build_flags(ctx, rtloader_root=rtloader_root)
+        _BUILD_ENV_CACHE[rtloader_root] = env
+    # callers may modify the returned env
+    return dict(_BUILD_ENV_CACHE[rtloader_root])
+
+class BufferedEchoContext(Context):
+    """
+    Context echoing its commands to its out_stream instead of stdout, so that
+    they stay with their output when that output is buffered.
+    """
+    def run(self, command, **kwargs):
+        if kwargs.pop('echo', self.config.run.echo):
+            self.config.run.out_stream.write(u"{}\n".format(command))
+        return super(BufferedEchoContext, self).run(command, echo=False, **kwargs)
+
+def get_lint_cache_env(ctx, golangci=False):
+    """
+    Print where the Go build cache lives and, if requested, return the env
+    pointing the golangci-lint cache to a stable path under GOPATH, so that
+    CI can persist them between runs. The Go build cache is left as
+    configured so it stays shared with the other go commands, and a
+    golangci-lint cache path set in the environment takes precedence.
+    """
+    print("using GOCACHE cache: {}".format(ctx.run("go env GOCACHE", hide=True).stdout.strip()))
+    env = {}
+    if golangci:
+        # GOPATH may list several directories, use the first one
+        gopath = get_gopath(ctx).split(os.pathsep)[0]
+        cache_dir = os.environ.get("GOLANGCI_LINT_CACHE") or os.path.join(gopath, ".cache", "golangci-lint")
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        print("using GOLANGCI_LINT_CACHE cache: {}".format(cache_dir))
+        env["GOLANGCI_LINT_CACHE"] = cache_dir
+    return env
+
+def get_changed_go_files(since, targets):
+    """
+    Return the Go files under targets that changed since the given git revision
+    """
+    try:
+        changed = check_output(["git", "diff", "--name-only", "--relative", since, "--", "*.go"]).decode('utf-8').split("\n")
+        # new files aren't part of the diff until they are tracked
+        changed += check_output(["git", "ls-files", "--others", "--exclude-standard", "--", "*.go"]).decode('utf-8').split("\n")
+    except CalledProcessError as e:
+        raise Exit(message="could not list the Go files changed since {}".format(since), code=e.returncode)
+    prefixes = [os.path.normpath(t) for t in targets]
+    files = []
+    for path in (os.path.normpath(f) for f in changed if f):
+        # skip deleted files
+        if not os.path.isfile(path):
+            continue
+        if any(p == os.curdir or path == p or path.startswith(p + os.sep) for p in prefixes):
+            files.append(path)
+    return files
+
+def check_call_echo(cmd):
+    """
+    Print and run a command outside of invoke's runner, for steps simple
+    enough not to need it. `inv -e` doesn't echo these commands, so print
+    them ourselves to keep them in the logs.
+    """
+    print(" ".join(cmd))
+    check_call(cmd)
+
 @task
-def fmt(ctx, targets, fail_on_fmt=False):
+def fmt(ctx, targets, fail_on_fmt=False, since=None):
     """
     Run go fmt on targets.
+    Use the 'since' parameter to only format the files changed since a git revision.
 
     Example invokation:
-        inv fmt --targets=./pkg/collector/check,./pkg/aggregator
+        inv fmt --targets=./pkg/collector/check,./pkg/aggregator --since=HEAD
     """
     if isinstance(targets, basestring):
         # when this function is called from the command line, targets are passed
         # as comma separated tokens in a string
         targets = targets.split(',')
 
+    if since:
+        targets = get_changed_go_files(since, targets)
+        if not targets:
+            print("no Go files changed since {}, skipping gofmt".format(since))
+            return
+
     result = ctx.run("gofmt -l -w -s " + " ".join(targets))
     if result.stdout:
         files = {x for x in result.stdout.split("\n") if x}
@@ -101,7 +196,7 @@ def lint(ctx, targets):
         files = []
         skipped_files = set()
         for line in (out for out in result.stdout.split('\n') if out):
-            fname = os.path.basename(line.split(":")[0])
+            fname = os.path.basename(line.partition(":")[0])
             if fname in MODULE_WHITELIST:
                 skipped_files.add(fname)
                 continue
@@ -136,7 +231,8 @@ def vet(ctx, targets, rtloader_root=None, build_tags=None, arch="x64"):
     tags = build_tags or get_default_build_tags(arch=arch)
     tags.append("dovet")
 
-    _, _, env = get_build_flags(ctx, rtloader_root=rtloader_root)
+    env = _get_build_env(ctx, rtloader_root=rtloader_root)
+    env.update(get_lint_cache_env(ctx))
 
     ctx.run("go vet -tags \"{}\" ".format(" ".join(tags)) + " ".join(args), env=env)
     # go vet exits with status 1 when it finds an issue, if we're here
@@ -165,10 +261,14 @@ def cyclo(ctx, targets, limit=15):
 
 
 @task
-def golangci_lint(ctx, targets, rtloader_root=None, build_tags=None):
+def golangci_lint(ctx, targets, rtloader_root=None, build_tags=None, low_memory=False):
     """
     Run golangci-lint on targets using .golangci.yml configuration.
 
+    All targets are linted in a single run so the packages are only loaded
+    once. Use --low-memory to lint targets one at a time instead, on hosts
+    where a single run goes over the memory limit.
+
     Example invocation:
         inv golangci_lint --targets=./pkg/collector/check,./pkg/aggregator
     """
@@ -179,11 +279,14 @@ def golangci_lint(ctx, targets, rtloader_root=None, build_tags=None):
 
     tags = build_tags or get_default_build_tags()
 
-    _, _, env = get_build_flags(ctx, rtloader_root=rtloader_root)
-    # we split targets to avoid going over the memory limit from circleCI
-    for target in targets:
-        print("running golangci on {}".format(target))
-        ctx.run("golangci-lint run -c .golangci.yml --build-tags '{}' {}".format(" ".join(tags), "{}/...".format(target)), env=env)
+    env = _get_build_env(ctx, rtloader_root=rtloader_root)
+    env.update(get_lint_cache_env(ctx, golangci=True))
+
+    # with low_memory we split targets to avoid going over the memory limit from circleCI
+    batches = [[target] for target in targets] if low_memory else [targets]
+    for batch in batches:
+        print("running golangci on {}".format(", ".join(batch)))
+        ctx.run("golangci-lint run -c .golangci.yml --build-tags '{}' {}".format(" ".join(tags), " ".join("{}/...".format(t) for t in batch)), env=env)
 
     # golangci exits with status 1 when it finds an issue, if we're here
     # everything went smooth
@@ -221,12 +324,25 @@ def misspell(ctx, targets):
         # as comma separated tokens in a string
         targets = targets.split(',')
 
-    result = ctx.run("misspell " + " ".join(targets), hide=True)
+    # stream misspell's output instead of buffering it, its output can be
+    # huge when most of the hits are in ignored targets. stderr goes to a
+    # temporary file so it's only shown if misspell fails
     legit_misspells = []
-    for found_misspell in result.stdout.split("\n"):
-        if len(found_misspell.strip()) > 0:
-            if not any([ignored_target in found_misspell for ignored_target in MISSPELL_IGNORED_TARGETS]):
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            proc = Popen(["misspell"] + targets, stdout=PIPE, stderr=stderr, universal_newlines=True)
+        except OSError as e:
+            raise Exit(message="could not run misspell: {}".format(e), code=1)
+        for found_misspell in proc.stdout:
+            found_misspell = found_misspell.rstrip("\n")
+            if found_misspell.strip() and not MISSPELL_IGNORED_RE.search(found_misspell):
                 legit_misspells.append(found_misspell)
+        proc.stdout.close()
+        if proc.wait() != 0:
+            stderr.seek(0)
+            print(stderr.read().decode('utf-8'), end="", file=sys.stderr)
+            print("misspell exited with status {}".format(proc.returncode))
+            raise Exit(code=proc.returncode)
 
     if len(legit_misspells) > 0:
         print("Misspell issues found:\n" + "\n".join(legit_misspells))
@@ -249,12 +365,41 @@ def deps(ctx, no_checks=False, core_dir=None, verbose=False, android=False, dep_
         print("processing checkout tool {}".format(dependency))
         process_deps(ctx, dependency, tool.get('version'), tool.get('type'), 'checkout', verbose=verbose)
 
-    order = deps.get("order", deps.keys())
-    for dependency in order:
+    install_failed = Event()
+
+    def install_tool(dependency):
+        # skip the pending installs once one has failed
+        if install_failed.is_set():
+            return
         tool = deps.get(dependency)
-        if tool.get('install', True):
-            print("processing get tool {}".format(dependency))
-            process_deps(ctx, dependency, tool.get('version'), tool.get('type'), 'install', cmd=tool.get('cmd'), verbose=verbose)
+        # each install gets its own context: it must not read from the
+        # terminal since several run at the same time, and its output (echoed
+        # commands included) is buffered to be printed at once instead of
+        # interleaving with the others
+        output = StringIO()
+        config = ctx.config.clone()
+        config.run.in_stream = False
+        config.run.out_stream = output
+        config.run.err_stream = output
+        try:
+            process_deps(BufferedEchoContext(config=config), dependency, tool.get('version'), tool.get('type'), 'install', cmd=tool.get('cmd'), verbose=verbose)
+        except Exception:
+            install_failed.set()
+            raise
+        finally:
+            print("processing get tool {}\n{}".format(dependency, output.getvalue()), end="")
+
+    # checkouts above have to run in order since several tools share the same
+    # repository in the GOPATH, but once everything is checked out the tools
+    # can be installed concurrently
+    order = deps.get("order", deps.keys())
+    to_install = [dependency for dependency in order if deps.get(dependency).get('install', True)]
+    pool = ThreadPool(max(1, min(len(to_install), DEPS_INSTALL_WORKERS)))
+    results = pool.map_async(install_tool, to_install, chunksize=1)
+    # wait for the running installs to finish before reporting a failure
+    pool.close()
+    pool.join()
+    results.get()
 
     if android:
         ndkhome = os.environ.get('ANDROID_NDK_HOME')
@@ -292,7 +437,8 @@ def deps(ctx, no_checks=False, core_dir=None, verbose=False, android=False, dep_
         # in because it's necessary on other platforms
         if not android and sys.platform == 'win32':
             print("Removing PSUTIL on Windows")
-            ctx.run("rd /s/q vendor\\github.com\\shirou\\gopsutil")
+            if os.path.exists('vendor/github.com/shirou/gopsutil'):
+                shutil.rmtree('vendor/github.com/shirou/gopsutil')
 
         # Make sure that golang.org/x/mobile is deleted.  It will get vendored in
         # because we use it, and there's no way to exclude; however, we must use
@@ -313,7 +459,12 @@ def deps(ctx, no_checks=False, core_dir=None, verbose=False, android=False, dep_
             core_dir = os.path.join(os.getcwd(), 'vendor', 'integrations-core')
             checks_base = os.path.join(core_dir, 'datadog_checks_base')
             if not os.path.isdir(core_dir):
-                ctx.run('git clone -{} https://github.com/DataDog/integrations-core {}'.format(verbosity, core_dir))
+                # we only need the latest revision, skip the history
+                ctx.run('git clone --depth=1 -{} https://github.com/DataDog/integrations-core {}'.format(verbosity, core_dir))
+            else:
+                print("Updating {}".format(core_dir))
+                ctx.run('git -C "{}" fetch --depth=1 -{} origin'.format(core_dir, verbosity))
+                ctx.run('git -C "{}" reset --hard -q FETCH_HEAD'.format(core_dir))
             ctx.run('pip install -{} "{}[deps]"'.format(verbosity, checks_base))
     checks_done = datetime.datetime.now()
 
@@ -328,33 +479,30 @@ def lint_licenses(ctx, verbose=False):
     """
     print("Verify licenses")
 
-    licenses = []
+    licenses = set()
     file='LICENSE-3rdparty.csv'
     with open(file, 'r') as f:
         next(f)
         for line in f:
-            licenses.append(line.rstrip())
+            licenses.add(line.rstrip())
 
-    new_licenses = get_licenses_list(ctx)
+    new_licenses = set(get_licenses_list(ctx))
 
     if sys.platform == 'win32':
         # ignore some licenses because we remove
         # the deps in a hack for windows
         ignore_licenses = ['github.com/shirou/gopsutil']
-        to_removed = []
-        for ignore in ignore_licenses:
-            for license in licenses:
-                if ignore in license:
-                    if verbose:
-                        print("[hack-windows] ignore: {}".format(license))
-                    to_removed.append(license)
-        licenses = [x for x in licenses if x not in to_removed]
-
-    removed_licenses = [ele for ele in new_licenses if ele not in licenses]
+        to_removed = {x for x in licenses if any(ignore in x for ignore in ignore_licenses)}
+        if verbose:
+            for license in sorted(to_removed):
+                print("[hack-windows] ignore: {}".format(license))
+        licenses -= to_removed
+
+    removed_licenses = sorted(new_licenses - licenses)
     for license in removed_licenses:
         print("+ {}".format(license))
 
-    added_licenses = [ele for ele in licenses if ele not in new_licenses]
+    added_licenses = sorted(licenses - new_licenses)
     for license in added_licenses:
         print("- {}".format(license))
 
@@ -370,12 +518,12 @@ def generate_licenses(ctx, filename='LICENSE-3rdparty.csv', verbose=False):
     """
     Generates that the LICENSE-3rdparty.csv file is up-to-date with contents of go.sum
     """
+    licenses = get_licenses_list(ctx)
     with open(filename, 'w') as f:
         f.write("Component,Origin,License\n")
-        for license in get_licenses_list(ctx):
-            if verbose:
-                print(license)
-            f.write('{}\n'.format(license))
+        f.writelines(license + "\n" for license in licenses)
+    if verbose:
+        print("\n".join(licenses))
     print("licenses files generated")
 
 def get_licenses_list(ctx):
@@ -383,18 +531,8 @@ def get_licenses_list(ctx):
     licenses=[]
     licenses.append('core,"github.com/frapposelli/wwhrd",MIT')
     if result.stderr:
-        for line in result.stderr.split("\n") :
-            index = line.find('msg="Found License"')
-            if index == -1:
-                continue
-            license = ""
-            package = ""
-            for val in line[index+len('msg="Found License"'):].split(" "):
-                if val.startswith('license='):
-                    license = val[len('license='):]
-                elif val.startswith('package='):
-                    package = val[len('package='):]
-                    licenses.append("core,{},{}".format(package,license))
+        for license, package in WWHRD_LICENSE_RE.findall(result.stderr):
+            licenses.append("core,{},{}".format(package, license))
     licenses.sort()
     return licenses
 
@@ -411,23 +549,25 @@ def lint_licenses_old(ctx):
     go_deps = set()
     with open('go.sum') as f:
         for line in f:
-            gopkg = line.split(" ")
-            if len(gopkg) != 3:
-                continue
-            go_deps.add(gopkg[0])
+            gopkg, sep, rest = line.partition(" ")
+            if sep and rest.count(" ") == 1:
+                go_deps.add(gopkg)
 
     deps = go_deps | NON_GO_DEPS
 
     # Read all dep names listed in LICENSE-3rdparty
-    licenses = csv.DictReader(open('LICENSE-3rdparty.csv'))
     license_deps = set()
-    for entry in licenses:
-        if len(entry['License']) == 0:
-            raise Exit(message="LICENSE-3rdparty entry '{}' has an empty license".format(entry['Origin']), code=1)
-        entrysplit = entry['Origin'].split("/")
-        entrysplit = entrysplit[0:3]
-        print('/'.join(entrysplit))
-        license_deps.add('/'.join(entrysplit))
+    with open('LICENSE-3rdparty.csv', newline='') as f:
+        licenses = csv.reader(f)
+        header = next(licenses)
+        origin_idx, license_idx = header.index('Origin'), header.index('License')
+        for entry in licenses:
+            origin, license = entry[origin_idx], entry[license_idx]
+            if len(license) == 0:
+                raise Exit(message="LICENSE-3rdparty entry '{}' has an empty license".format(origin), code=1)
+            entrysplit = origin.split("/", 3)[0:3]
+            print('/'.join(entrysplit))
+            license_deps.add('/'.join(entrysplit))
 
     if deps != license_deps:
         raise Exit(message="LICENSE-3rdparty.csv is outdated compared to deps listed in go.sum:\n" +
@@ -442,20 +582,39 @@ def reset(ctx):
     """
     # go clean
     print("Executing go clean")
-    ctx.run("go clean")
+    try:
+        check_call_echo(["go", "clean"])
+    except CalledProcessError as e:
+        raise Exit(message="go clean failed", code=e.returncode)
 
     # remove the bin/ folder
     print("Remove agent binary folder")
-    ctx.run("rm -rf ./bin/")
+    if os.path.exists("bin"):
+        shutil.rmtree("bin")
 
     # remove vendor folder
     print("Remove vendor folder")
-    ctx.run("rm -rf ./vendor")
+    if os.path.exists("vendor"):
+        shutil.rmtree("vendor")
 
 @task
 def generate(ctx):
     """
     Run go generate required package
     """
-    ctx.run("go generate -mod=vendor " + " ".join(GO_GENERATE_TARGETS))
+    def generate_target(target):
+        check_call_echo(["go", "generate", "-mod=vendor", target])
+
+    # the go:generate directives of the targets are independent from each
+    # other, run them concurrently
+    pool = ThreadPool(max(1, len(GO_GENERATE_TARGETS)))
+    results = pool.map_async(generate_target, GO_GENERATE_TARGETS, chunksize=1)
+    # wait for every go generate to finish before reporting a failure, so
+    # that none keeps writing files afterwards
+    pool.close()
+    pool.join()
+    try:
+        results.get()
+    except CalledProcessError as e:
+        raise Exit(message="go generate failed on {}".format(e.cmd[-1]), code=e.returncode)
     print("go generate ran successfully")
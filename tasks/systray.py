@@ -91,4 +91,6 @@ def clean(ctx):
 
     # remove the bin/agent folder
     print("Remove systray executable")
-    ctx.run("rm -rf ./bin/agent/ddtray.exe")
+    ddtray = os.path.join("bin", "agent", "ddtray.exe")
+    if os.path.exists(ddtray):
+        os.remove(ddtray)
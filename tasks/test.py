@@ -5,6 +5,7 @@ from __future__ import print_function
 
 import os
 import re
+import shutil
 import operator
 import sys
 import yaml
@@ -45,7 +46,7 @@ def test(ctx, targets=None, coverage=False, build_include=None, build_exclude=No
     verbose=False, race=False, profile=False, fail_on_fmt=False,
     rtloader_root=None, python_home_2=None, python_home_3=None, cpus=0, major_version='7',
     python_runtimes='3', timeout=120, arch="x64", cache=True, skip_linters=False,
-    go_mod="vendor"):
+    go_mod="vendor", low_memory=False):
     """
     Run all the tools and tests on the given targets. If targets are not specified,
     the value from `invoke.yaml` will be used.
@@ -96,7 +97,7 @@ def test(ctx, targets=None, coverage=False, build_include=None, build_exclude=No
         # for now we only run golangci_lint on Unix as the Windows env need more work
         if sys.platform != 'win32':
             print("--- golangci_lint:")
-            golangci_lint(ctx, targets=tool_targets, rtloader_root=rtloader_root, build_tags=build_tags)
+            golangci_lint(ctx, targets=tool_targets, rtloader_root=rtloader_root, build_tags=build_tags, low_memory=low_memory)
 
     with open(PROFILE_COV, "w") as f_cov:
         f_cov.write("mode: count")
@@ -462,5 +463,6 @@ def install_shellcheck(ctx, version="0.7.0", destination="/usr/local/bin"):
         .format(sc_version=version, platform=platform))
     ctx.run("cp \"/tmp/shellcheck-v{sc_version}/shellcheck\" {destination}"
         .format(sc_version=version, destination=destination))
-    ctx.run("rm -rf \"/tmp/shellcheck-v{sc_version}\""
-        .format(sc_version=version))
+    extract_dir = "/tmp/shellcheck-v{sc_version}".format(sc_version=version)
+    if os.path.exists(extract_dir):
+        shutil.rmtree(extract_dir)